@@ -20,7 +20,8 @@ setup(name="pipelinewise-target-bigquery",
       install_requires=[
           'pipelinewise-singer-python>=1,<3',
           'google-cloud-bigquery>=2.20.0,<3.1.0',
-          'fastavro>=0.22.8,<1.4.11'
+          'fastavro>=0.22.8,<1.4.11',
+          'orjson>=3.6,<4'
       ],
       extras_require={
           "test": [
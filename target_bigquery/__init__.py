@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
 
 import argparse
-from datetime import datetime, timedelta
 import copy
 import io
 import json
 import logging
 import os
+import re
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from multiprocessing.pool import ThreadPool as Pool
 
-from tempfile import mkstemp
-from fastavro import writer, parse_schema
+from tempfile import SpooledTemporaryFile
+import orjson
+import fastavro.write
+from fastavro import writer
 from jsonschema import Draft7Validator, FormatChecker
 from singer import get_logger
 
@@ -30,6 +35,13 @@ DEFAULT_PARALLELISM = 0  # 0 The number of threads used to flush tables
 DEFAULT_MAX_PARALLELISM = 16  # Don't use more than this number of threads by default when flushing streams in parallel
 DEFAULT_HARD_DELETE = False
 DEFAULT_APPEND_ONLY = False
+DEFAULT_PARALLEL_TRANSFORM = False
+# orjson parses integers beyond 64 bits as floats losing precision, lines with
+# numbers that long are parsed by the json module instead
+LONG_NUMBER_PATTERN = re.compile(r'-?\d{19}')
+MAX_AVRO_BUFFER_SIZE = 256 * 1024 * 1024  # Avro batches bigger than this are spilled from memory to a temp file
+AVRO_CHUNK_SIZE_ROWS = 10000  # Rows serialised by each worker process when streams are split in chunks
+AVRO_SPLIT_MIN_ROWS = 25000  # Streams flushing at least this number of rows are always split in chunks
 
 
 def add_metadata_columns_to_schema(schema_message):
@@ -51,15 +63,46 @@ def add_metadata_columns_to_schema(schema_message):
 
 
 def emit_state(state):
+    # state is serialised straight away so callers don't need to pass a copy
     if state is not None:
-        line = json.dumps(state)
-        LOGGER.info('Emitting state {}'.format(line))
-        sys.stdout.write("{}\n".format(line))
-        sys.stdout.flush()
+        try:
+            line = orjson.dumps(state, option=orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            # orjson can't serialise integers beyond 64 bits
+            line = '{}\n'.format(json.dumps(state)).encode('utf-8')
+        if LOGGER.isEnabledFor(logging.INFO):
+            LOGGER.info('Emitting state {}'.format(line.decode('utf-8').rstrip()))
+        sys.stdout.buffer.write(line)
+        sys.stdout.buffer.flush()
+
+
+def parse_line(line):
+    """Parse a singer message with orjson, falling back to the json module for what orjson doesn't parse exactly"""
+    if LONG_NUMBER_PATTERN.search(line):
+        return json.loads(line)
+    try:
+        return orjson.loads(line)
+    except orjson.JSONDecodeError:
+        # NaN, Infinity and floats out of range like 1e400 are only accepted by the json module
+        return json.loads(line)
+
+
+def avro_workers(config):
+    """Number of worker processes serialising Avro. It's CPU bound so there are never more workers than cores"""
+    cpu_count = os.cpu_count() or 1
+    if config.get('parallel_transform', DEFAULT_PARALLEL_TRANSFORM):
+        return cpu_count
+
+    # parallelism 0 is one thread per stream up to max_parallelism and -1 one thread per CPU core
+    parallelism = config.get('parallelism', DEFAULT_PARALLELISM) or \
+        config.get('max_parallelism', DEFAULT_MAX_PARALLELISM)
+    if parallelism < 0:
+        return cpu_count
+    return max(1, min(parallelism, cpu_count))
 
 
 # pylint: disable=too-many-locals,too-many-branches,too-many-statements
-def persist_lines(config, lines) -> None:
+def persist_lines(config, lines, executor=None) -> None:
     state = None
     flushed_state = None
     schemas = {}
@@ -70,10 +113,17 @@ def persist_lines(config, lines) -> None:
     flush_timestamp = {}
     stream_to_sync = {}
     total_row_count = {}
+    add_metadata_values = {}
+    timestamp_properties = {}
+    schema_fingerprints = {}
+    validate_decimals = {}
     batch_size_rows = config.get('batch_size_rows', DEFAULT_BATCH_SIZE_ROWS)
     default_hard_delete = config.get('hard_delete', DEFAULT_HARD_DELETE)
     hard_delete_mapping = config.get('hard_delete_mapping', {})
     batch_wait_limit_seconds = config.get('batch_wait_limit_seconds', None)
+    validate_records = config.get('validate_records')
+    add_metadata_columns = config.get('add_metadata_columns')
+    flush_all_streams = config.get('flush_all_streams')
 
     # Loop over lines from stdin
     for line in lines:
@@ -82,13 +132,14 @@ def persist_lines(config, lines) -> None:
         # of time to be processed.
         streams_to_flush_timestamp = set()
         if batch_wait_limit_seconds:
+            now = time.monotonic()
             streams_to_flush_timestamp = {
                 stream for stream, timestamp in flush_timestamp.items()
-                if datetime.utcnow() >= timestamp + timedelta(seconds=batch_wait_limit_seconds)
+                if now >= timestamp + batch_wait_limit_seconds
             }
 
         try:
-            o = json.loads(line)
+            o = parse_line(line)
         except json.decoder.JSONDecodeError:
             LOGGER.error("Unable to parse:\n{}".format(line))
             raise
@@ -107,36 +158,42 @@ def persist_lines(config, lines) -> None:
 
             # Get schema for this record's stream
             stream = o['stream']
+            record = o['record']
 
-            stream_utils.adjust_timestamps_in_record(o['record'], schemas[stream])
+            stream_utils.adjust_timestamps(record, timestamp_properties[stream])
 
             # Validate record
-            if config.get('validate_records'):
+            if validate_records:
                 try:
-                    validators[stream].validate(stream_utils.float_to_decimal(o['record']))
+                    if validate_decimals[stream]:
+                        validators[stream].validate(stream_utils.float_to_decimal(record))
+                    else:
+                        validators[stream].validate(record)
                 except Exception as ex:
                     if type(ex).__name__ == "InvalidOperation":
                         raise InvalidValidationOperationException(
-                            f"Data validation failed and cannot load to destination. RECORD: {o['record']}\n"
+                            f"Data validation failed and cannot load to destination. RECORD: {record}\n"
                             "multipleOf validations that allows long precisions are not supported (i.e. with 15 digits"
                             "or more) Try removing 'multipleOf' methods from JSON schema.")
-                    raise RecordValidationException(f"Record does not pass schema validation. RECORD: {o['record']}")
+                    raise RecordValidationException(f"Record does not pass schema validation. RECORD: {record}")
 
-            primary_key_string = stream_to_sync[stream].record_primary_key_string(o['record'])
+            primary_key_string = stream_to_sync[stream].record_primary_key_string(record)
             if not primary_key_string:
                 primary_key_string = 'RID-{}'.format(total_row_count[stream])
 
-            # increment row count only when a new PK is encountered in the current batch
-            if primary_key_string not in records_to_load[stream]:
+            # append record
+            if add_metadata_values[stream]:
+                record = stream_utils.add_metadata_values_to_record(o)
+            stream_records = records_to_load[stream]
+            n_stream_records = len(stream_records)
+            stream_records[primary_key_string] = record
+
+            # increment row count only when a new PK is encountered in the current batch,
+            # comparing sizes avoids looking up the PK twice
+            if len(stream_records) > n_stream_records:
                 row_count[stream] += 1
                 total_row_count[stream] += 1
 
-            # append record
-            if config.get('add_metadata_columns') or hard_delete_mapping.get(stream, default_hard_delete):
-                records_to_load[stream][primary_key_string] = stream_utils.add_metadata_values_to_record(o)
-            else:
-                records_to_load[stream][primary_key_string] = o['record']
-
             flush = False
             if row_count[stream] >= batch_size_rows:
                 flush = True
@@ -149,7 +206,7 @@ def persist_lines(config, lines) -> None:
 
             if flush:
                 # flush all streams, delete records if needed, reset counts and then emit current state
-                if config.get('flush_all_streams'):
+                if flush_all_streams:
                     filter_streams = None
                 else:
                     filter_streams = list(streams_to_flush_timestamp | {stream})
@@ -162,12 +219,13 @@ def persist_lines(config, lines) -> None:
                     config,
                     state,
                     flushed_state,
-                    filter_streams=filter_streams)
+                    filter_streams=filter_streams,
+                    executor=executor)
 
                 flush_timestamp.update(flushed_timestamps)
 
                 # emit last encountered state
-                emit_state(copy.deepcopy(flushed_state))
+                emit_state(flushed_state)
 
         elif t == 'SCHEMA':
             if 'stream' not in o:
@@ -175,20 +233,31 @@ def persist_lines(config, lines) -> None:
 
             stream = o['stream']
 
+            # Some taps send the same SCHEMA message again before every batch. The table is
+            # already in sync with it so there's nothing to flush or change in BigQuery
+            schema_fingerprint = json.dumps(o, sort_keys=True)
+            if schema_fingerprints.get(stream) == schema_fingerprint:
+                LOGGER.debug('SCHEMA message of stream {} has not changed'.format(stream))
+                continue
+
             schemas[stream] = stream_utils.float_to_decimal(o['schema'])
-            validators[stream] = Draft7Validator(schemas[stream], format_checker=FormatChecker())
+            timestamp_properties[stream] = stream_utils.get_timestamp_properties(schemas[stream])
+            if validate_records:
+                validators[stream] = Draft7Validator(schemas[stream], format_checker=FormatChecker())
+                validate_decimals[stream] = stream_utils.schema_has_numbers(schemas[stream])
 
             # flush records from previous stream SCHEMA
             # if same stream has been encountered again, it means the schema might have been altered
             # so previous records need to be flushed
             if row_count.get(stream, 0) > 0:
-                if config.get('flush_all_streams'):
+                if flush_all_streams:
                     filter_streams = None
                 else:
                     filter_streams = list(streams_to_flush_timestamp | {stream})
 
                 flushed_state, flushed_timestamps = flush_streams(
-                    records_to_load, row_count, stream_to_sync, config, state, flushed_state, filter_streams=filter_streams
+                    records_to_load, row_count, stream_to_sync, config, state, flushed_state,
+                    filter_streams=filter_streams, executor=executor
                 )
 
                 flush_timestamp.update(flushed_timestamps)
@@ -213,8 +282,9 @@ def persist_lines(config, lines) -> None:
                 raise Exception("key_properties field is required")
 
             key_properties[stream] = o['key_properties']
+            add_metadata_values[stream] = add_metadata_columns or hard_delete_mapping.get(stream, default_hard_delete)
 
-            if config.get('add_metadata_columns') or hard_delete_mapping.get(stream, default_hard_delete):
+            if add_metadata_values[stream]:
                 stream_to_sync[stream] = DbSync(config, add_metadata_columns_to_schema(o))
             else:
                 stream_to_sync[stream] = DbSync(config, o)
@@ -232,7 +302,8 @@ def persist_lines(config, lines) -> None:
             records_to_load[stream] = {}
             row_count[stream] = 0
             total_row_count[stream] = 0
-            flush_timestamp[stream] = datetime.utcnow()
+            flush_timestamp[stream] = time.monotonic()
+            schema_fingerprints[stream] = schema_fingerprint
 
         elif t == 'ACTIVATE_VERSION':
             stream = o['stream']
@@ -263,10 +334,11 @@ def persist_lines(config, lines) -> None:
     # then flush all buckets.
     if sum(row_count.values()) > 0:
         # flush all streams one last time, delete records if needed, reset counts and then emit current state
-        flushed_state, _ = flush_streams(records_to_load, row_count, stream_to_sync, config, state, flushed_state)
+        flushed_state, _ = flush_streams(records_to_load, row_count, stream_to_sync, config, state, flushed_state,
+                                         executor=executor)
 
     # emit latest state
-    emit_state(copy.deepcopy(flushed_state))
+    emit_state(flushed_state)
 
 
 # pylint: disable=too-many-arguments
@@ -277,7 +349,8 @@ def flush_streams(
         config,
         state,
         flushed_state,
-        filter_streams=None):
+        filter_streams=None,
+        executor=None):
     """
     Flushes all buckets and resets records count to 0 as well as empties records to load list
     :param streams: dictionary with records to load per stream
@@ -287,14 +360,16 @@ def flush_streams(
     :param state: dictionary containing the original state from tap
     :param flushed_state: dictionary containing updated states only when streams got flushed
     :param filter_streams: Keys of streams to flush from the streams dict. Default is every stream
+    :param executor: process pool serialising Avro, shared by every flush. A new one is started if not given
     :return: State dict with flushed positions
-    :return: Dictionary with flush timestamps for each stream flushed
+    :return: Dictionary with monotonic clock flush timestamps for each stream flushed
     """
     parallelism = config.get("parallelism", DEFAULT_PARALLELISM)
     max_parallelism = config.get("max_parallelism", DEFAULT_MAX_PARALLELISM)
     default_hard_delete = config.get("hard_delete", DEFAULT_HARD_DELETE)
     default_append_only = config.get("append_only", DEFAULT_APPEND_ONLY)
     hard_delete_mapping = config.get("hard_delete_mapping", {})
+    parallel_transform = config.get("parallel_transform", DEFAULT_PARALLEL_TRANSFORM)
 
     # Parallelism 0 means auto parallelism:
     #
@@ -307,6 +382,9 @@ def flush_streams(
             parallelism = max_parallelism
         else:
             parallelism = n_streams_to_flush
+    # -1 means a thread per CPU core
+    elif parallelism < 0:
+        parallelism = os.cpu_count() or 1
 
     # Select the required streams to flush
     if filter_streams:
@@ -314,27 +392,63 @@ def flush_streams(
     else:
         streams_to_flush = list(streams.keys())
 
-    if len(streams_to_flush) > 1:
+    # Big streams are split in chunks serialised in parallel and joined in a single Avro file,
+    # with parallel_transform every stream is split. A single worker would only add pickling
+    # while this process waits, so nothing is split then
+    split_streams = set()
+    if avro_workers(config) > 1:
+        split_streams = {stream for stream in streams_to_flush
+                         if parallel_transform or row_count[stream] >= AVRO_SPLIT_MIN_ROWS}
+
+    if len(streams_to_flush) > 1 or split_streams:
         # Single-host, process-based parallelism to avoid the dreaded GIL.
-        with Pool(parallelism) as pool:
-            jobs = []
-            for stream in streams_to_flush:
-                jobs.append(
-                    pool.apply_async(
-                        load_stream_batch,
-                        kwds={
-                            'stream': stream,
-                            'records_to_load': streams[stream],
-                            'row_count': row_count,
-                            'db_sync': stream_to_sync[stream],
-                            'delete_rows': hard_delete_mapping.get(
-                                stream, default_hard_delete
-                            ),
-                        },
+        # Avro serialisation is CPU bound so it runs in worker processes, the load
+        # jobs are network bound and run in threads sharing the BigQuery clients.
+        # The biggest stream that isn't split is serialised in this process so its records don't need pickling.
+        streams_to_load = [stream for stream in streams_to_flush if row_count[stream] > 0]
+        unsplit_streams = [stream for stream in streams_to_load if stream not in split_streams]
+        in_process_stream = max(unsplit_streams, key=row_count.get) if unsplit_streams else None
+
+        avro_chunks = {}
+        with nullcontext(executor) if executor else ProcessPoolExecutor(avro_workers(config)) as avro_executor:
+            for stream in streams_to_load:
+                if stream == in_process_stream:
+                    continue
+                records = list(streams[stream].values())
+                chunk_size = AVRO_CHUNK_SIZE_ROWS if stream in split_streams else len(records)
+                # the chunks share the sync marker so they can be concatenated into one Avro file
+                sync_marker = os.urandom(16)
+                avro_chunks[stream] = [
+                    avro_executor.submit(
+                        write_avro_batch,
+                        stream_to_sync[stream],
+                        records[i:i + chunk_size],
+                        sync_marker,
+                        i == 0
                     )
-                )
-            for future in jobs:
-                future.get()
+                    for i in range(0, len(records), chunk_size)
+                ]
+
+            with Pool(parallelism) as pool:
+                jobs = []
+                for stream in streams_to_flush:
+                    jobs.append(
+                        pool.apply_async(
+                            load_stream_batch,
+                            kwds={
+                                'stream': stream,
+                                'records_to_load': streams[stream],
+                                'row_count': row_count,
+                                'db_sync': stream_to_sync[stream],
+                                'delete_rows': hard_delete_mapping.get(
+                                    stream, default_hard_delete
+                                ),
+                                'avro_chunks': avro_chunks.get(stream),
+                            },
+                        )
+                    )
+                for future in jobs:
+                    future.get()
     else:
         # If we only have one stream to sync let's not introduce overhead.
         # for stream in streams_to_flush:
@@ -366,33 +480,54 @@ def flush_streams(
         else:
             flushed_state = copy.deepcopy(state)
 
-    flushed_timestamps = {stream: datetime.utcnow() for stream in streams_to_flush}
+    flushed_timestamps = {stream: time.monotonic() for stream in streams_to_flush}
     # Return with state message with flushed positions
     return flushed_state, flushed_timestamps
 
 
-def load_stream_batch(stream, records_to_load, row_count, db_sync, delete_rows=False):
+def load_stream_batch(stream, records_to_load, row_count, db_sync, delete_rows=False, avro_chunks=None):
     # Load into bigquery
     if row_count[stream] > 0:
-        flush_records(stream, records_to_load, row_count[stream], db_sync)
+        # Soft-deleted, flagged rows - where _sdc_deleted at is not null - get deleted
+        # in the same query job that merges the batch
+        flush_records(stream, records_to_load, row_count[stream], db_sync, avro_chunks, delete_rows)
+
+
+def write_avro(out, db_sync, records, sync_marker=None):
+    """Write records as an Avro file. The values are already converted to match the schema so they aren't validated"""
+    writer(out, db_sync.parsed_avro_schema(), db_sync.records_to_avro(records),
+           codec=db_sync.avro_codec, validator=False, sync_marker=sync_marker)
+
 
-        # Delete soft-deleted, flagged rows - where _sdc_deleted at is not null
-        if delete_rows:
-            db_sync.delete_rows(stream)
+def write_avro_batch(db_sync, records, sync_marker=None, header=True):
+    """Serialise records into Avro and return the content of the file as bytes
 
+    Runs in worker processes so it only receives picklable arguments.
+    Without header only the data blocks are returned, to be appended to a file written with the same sync marker
+    """
+    out = io.BytesIO()
+    write_avro(out, db_sync, records, sync_marker)
+    if header:
+        return out.getvalue()
+
+    header_size = len(write_avro_batch(db_sync, [], sync_marker))
+    return out.getvalue()[header_size:]
 
-def flush_records(stream, records_to_load, row_count, db_sync):
-    parsed_schema = parse_schema(db_sync.avro_schema())
-    csv_fd, csv_file = mkstemp()
-    with open(csv_file, 'wb') as out:
-        writer(out, parsed_schema, db_sync.records_to_avro(records_to_load.values()))
 
-    # Seek to the beginning of the file and load
-    with open(csv_file, 'r+b') as f:
-        db_sync.load_avro(f, row_count)
+def flush_records(stream, records_to_load, row_count, db_sync, avro_chunks=None, delete_rows=False):
+    # BigQuery refuses to upload files that are not opened in read mode, hence r+b
+    with SpooledTemporaryFile(max_size=MAX_AVRO_BUFFER_SIZE, mode='r+b') as out:
+        if avro_chunks is None:
+            write_avro(out, db_sync, records_to_load.values())
+        else:
+            # Serialised by worker processes. Every chunk is written to the file as soon as it's
+            # ready and released, so only the file is kept in memory and it spills to disk when it grows
+            while avro_chunks:
+                out.write(avro_chunks.pop(0).result())
 
-    # Delete temp file
-    os.remove(csv_file)
+        # Seek to the beginning of the file and load
+        out.seek(0)
+        db_sync.load_avro(out, row_count, delete_rows)
 
 
 def main():
@@ -406,9 +541,17 @@ def main():
     else:
         config = {}
 
+    # fastavro silently falls back to its pure python writer when the compiled one can't be
+    # imported, which makes flushing several times slower
+    # pylint: disable=protected-access
+    if fastavro.write._write.__name__ == 'fastavro._write_py':
+        LOGGER.warning('fastavro C extension is not available, using the slower pure python Avro writer')
+
     # Consume singer messages
     singer_messages = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
-    persist_lines(config, singer_messages)
+    # worker processes are started once and serialise the Avro batches of every flush
+    with ProcessPoolExecutor(avro_workers(config)) as executor:
+        persist_lines(config, singer_messages, executor)
 
     LOGGER.debug("Exiting normally")
 
@@ -1,11 +1,16 @@
+import functools
+import io
 import json
+import os
 import sys
 import singer
 import re
 import time
 import datetime
-from decimal import Decimal, getcontext
+from decimal import Decimal, ROUND_HALF_EVEN, getcontext
+from fastavro import parse_schema, writer
 
+from google.api_core import exceptions, retry
 from google.cloud import bigquery
 from google.cloud.bigquery import SchemaField
 from google.cloud.exceptions import Conflict
@@ -18,12 +23,68 @@ from target_bigquery import sql_utils
 logger = singer.get_logger()
 
 BIGQUERY_NUM_CLUSTERED_COLUMNS_LIMIT = 4
+DEFAULT_HTTP_POOL_SIZE = 16  # Same as the default max_parallelism, one connection per flushing thread
 PRECISION = 38
 SCALE = 9
+DEFAULT_AVRO_CODEC = 'deflate'  # Smaller uploads for little CPU, snappy needs the optional python-snappy package
+AVRO_CODECS = ('null', 'deflate', 'snappy')
+UNSAFE_AVRO_NAME_CHARS = re.compile(r'[^A-Za-z0-9_]')
+# Suffixes added to the names of versioned columns
+COLUMN_TYPE_SUFFIXES = {
+    'timestamp': 'ti',
+    'date': 'dy',
+    'time': 'tm',
+    'numeric': 'de',
+    'string': 'st',
+    'int64': 'it',
+    'integer': 'it',
+    'bool': 'bo',
+    'boolean': 'bo',
+    'array': 'arr',
+    'struct': 'sct'}
 getcontext().prec = PRECISION
 # Limit decimals to the same precision and scale as BigQuery accepts
 ALLOWED_DECIMALS = Decimal(10) ** Decimal(-SCALE)
 MAX_NUM = (Decimal(10) ** Decimal(PRECISION-SCALE)) - ALLOWED_DECIMALS
+MAX_INT = int(MAX_NUM)
+# Same output as json.dumps, which is what gets stored in the columns of unstructured objects
+JSON_ENCODER = json.JSONEncoder()
+# Looked up by exact type, bool is a subclass of int and would match INT64 with isinstance
+QUERY_PARAMETER_TYPES = {
+    bool: "BOOL",
+    int: "INT64",
+    float: "NUMERIC",
+    Decimal: "NUMERIC"}
+
+# Datasets already created or found by this process, every stream usually shares the same ones
+EXISTING_DATASETS = set()
+# Retry jobs failing with transient errors using exponential backoff, Retry adds random jitter
+# to every delay. Errors caused by the request itself, like BadRequest, are not retried.
+RETRY_TRANSIENT_ERRORS = retry.Retry(
+    predicate=retry.if_exception_type(
+        exceptions.InternalServerError,
+        exceptions.BadGateway,
+        exceptions.ServiceUnavailable,
+        exceptions.TooManyRequests),
+    initial=1.0,
+    maximum=60.0,
+    multiplier=2.0,
+    deadline=600.0)
+
+@functools.lru_cache(maxsize=None)
+def get_client(project_id, location=None, pool_size=DEFAULT_HTTP_POOL_SIZE):
+    """BigQuery client shared by every stream with the same project and location
+
+    Sharing the client reuses its HTTP connections and credentials instead of
+    opening new ones for every stream. The connection pool is sized for the
+    number of threads flushing streams in parallel.
+    """
+    client = bigquery.Client(project=project_id, location=location)
+    # The adapter already mounted is resized instead of replaced, with mTLS it's the one sending the client certificate
+    # pylint: disable=protected-access
+    client._http.get_adapter('https://').init_poolmanager(pool_size, pool_size)
+    return client
+
 
 def validate_config(config):
     errors = []
@@ -42,9 +103,36 @@ def validate_config(config):
     if not config_default_target_schema and not config_schema_mapping:
         errors.append("Neither 'default_target_schema' (string) nor 'schema_mapping' (object) keys set in config.")
 
+    avro_codec = config.get('avro_codec', DEFAULT_AVRO_CODEC)
+    if avro_codec not in AVRO_CODECS:
+        errors.append("Invalid 'avro_codec' in config, it has to be one of: {}".format(', '.join(AVRO_CODECS)))
+    elif not avro_codec_available(avro_codec):
+        errors.append("The '{}' avro_codec needs a library that is not installed".format(avro_codec))
+
     return errors
 
 
+def avro_number(value):
+    """Decimal of a number limited to the precision and scale of BigQuery NUMERIC columns"""
+    n = value if type(value) is Decimal else Decimal(value)
+    # limit n to the range -MAX_NUM to MAX_NUM
+    if n > MAX_NUM:
+        return MAX_NUM
+    if n < -MAX_NUM:
+        return -MAX_NUM
+    return n.quantize(ALLOWED_DECIMALS, ROUND_HALF_EVEN)
+
+
+def avro_codec_available(codec):
+    """fastavro only fails when it compresses the first block with a codec whose library is missing,
+    so a block is written to check it before any record is loaded"""
+    try:
+        writer(io.BytesIO(), {'type': 'record', 'name': 'codec_check', 'fields': []}, [{}], codec=codec)
+    except ValueError:
+        return False
+    return True
+
+
 # pylint: disable=no-else-return,too-many-branches,too-many-return-statements
 def bigquery_type(property_type, property_format):
     # Every date-time JSON value is currently mapped to TIMESTAMP WITHOUT TIME ZONE
@@ -167,6 +255,36 @@ def is_unstructured_object(props):
     return 'object' in props['type'] and not props.get('properties')
 
 
+# How records_to_avro converts the values of a column
+AVRO_VALUE = 0
+AVRO_JSON = 1
+AVRO_JSON_ITEMS = 2
+AVRO_NUMBER = 3
+
+
+def avro_conversion(props):
+    """Find how the values of a property need to be converted before writing them to Avro"""
+    if is_unstructured_object(props):
+        return AVRO_JSON
+    # dump to string if array without items or recursive
+    if 'array' in props['type'] and ('items' not in props or '$ref' in props['items']):
+        return AVRO_JSON
+    # dump array elements to strings
+    if 'array' in props['type'] and is_unstructured_object(props['items']):
+        return AVRO_JSON_ITEMS
+    if 'number' in props['type']:
+        return AVRO_NUMBER
+    return AVRO_VALUE
+
+
+def strip_datetime_suffix(name):
+    """Remove the %Y%m%d_%H%M suffix that version_column adds to the names of array and struct columns"""
+    suffix = name[-13:]
+    if len(suffix) == 13 and suffix[8] == '_' and suffix.isascii() and (suffix[:8] + suffix[9:]).isdigit():
+        return name[:-13]
+    return name
+
+
 def primary_column_names(stream_schema_message):
     try:
         return [sql_utils.safe_column_name(p) for p in stream_schema_message['key_properties']]
@@ -208,7 +326,9 @@ class DbSync:
 
         project_id = self.connection_config['project_id']
         location = self.connection_config.get('location', None)
-        self.client = bigquery.Client(project=project_id, location=location)
+        pool_size = self.connection_config.get('max_parallelism', DEFAULT_HTTP_POOL_SIZE)
+        self.client = get_client(project_id, location, pool_size)
+        self.avro_codec = self.connection_config.get('avro_codec', DEFAULT_AVRO_CODEC)
 
         self.schema_name = None
         self.grantees = None
@@ -227,7 +347,7 @@ class DbSync:
             #                                           "schema_mapping": {
             #                                               "my_tap_stream_id": {
             #                                                   "target_schema": "my_bigquery_schema",
-            #                                                   "target_schema_select_permissions": [ "role_with_select_privs" ]
+            #                                                   "target_schema_select_permissions": [ "readers@example.com" ]
             #                                               }
             #                                           }
             config_default_target_schema = self.connection_config.get('default_target_schema', '').strip()
@@ -247,16 +367,16 @@ class DbSync:
             #  ---------------
             #  Grantees can be defined in multiple ways:
             #
-            #   1: 'default_target_schema_select_permissions' key  : USAGE and SELECT privileges will be granted on every table to a given role
-            #                                                       for every incoming stream if not specified explicitly
+            #   1: 'default_target_schema_select_permissions' key  : Google groups, by email, that get READER access to the dataset
+            #                                                       of every incoming stream if not specified explicitly
             #                                                       in the `schema_mapping` object
-            #   2: 'target_schema_select_permissions' key          : Roles to grant USAGE and SELECT privileges defined explicitly
-            #                                                       for a given stream.
+            #   2: 'target_schema_select_permissions' key          : Google groups, by email, that get READER access to the dataset
+            #                                                       defined explicitly for a given stream.
             #                                                       Example config.json:
             #                                                           "schema_mapping": {
             #                                                               "my_tap_stream_id": {
             #                                                                   "target_schema": "my_bigquery_schema",
-            #                                                                   "target_schema_select_permissions": [ "role_with_select_privs" ]
+            #                                                                   "target_schema_select_permissions": [ "readers@example.com" ]
             #                                                               }
             #                                                           }
             self.grantees = self.connection_config.get('default_target_schema_select_permissions')
@@ -271,17 +391,27 @@ class DbSync:
                                            self.connection_config.get('temp_schema')
                                        )
             self.renamed_columns = {}
+            self._load_from_temp_table_sql = None
+            self._target_table = None
+            self._schema_fields = None
+            self._avro_schema_fields = None
+            self._primary_keys = [sql_utils.safe_column_name(p, quotes=False)
+                                  for p in stream_schema_message['key_properties']]
+            self._column_names = [sql_utils.safe_column_name(name) for name in self.flatten_schema]
+            # The schema is digested once instead of checking the types of every column for every record
+            self._avro_conversions = [(name, avro_conversion(props)) for name, props in self.flatten_schema.items()]
+            self._parsed_avro_schema = None
+
+    def __getstate__(self):
+        # The BigQuery client holds credentials and open connections so it can't be pickled.
+        # Copies sent to worker processes only serialise records and don't need it.
+        state = self.__dict__.copy()
+        state['client'] = None
+        return state
 
     def query(self, query, params=[]):
         def to_query_parameter(value):
-            if isinstance(value, int):
-                value_type = "INT64"
-            elif isinstance(value, float):
-                value_type = "NUMERIC"
-            elif isinstance(value, bool):
-                value_type = "BOOL"
-            else:
-                value_type = "STRING"
+            value_type = QUERY_PARAMETER_TYPES.get(type(value), "STRING")
             return bigquery.ScalarQueryParameter(None, value_type, value)
 
         job_config = bigquery.QueryJobConfig()
@@ -301,21 +431,28 @@ class DbSync:
         return query_job
 
     def record_primary_key_string(self, record):
-        if len(self.stream_schema_message['key_properties']) == 0:
+        key_properties = self.stream_schema_message['key_properties']
+        if len(key_properties) == 0:
             return None
+
+        # Without flattening the primary keys are usually top level keys of the record
+        # so there's no need to flatten the whole record only to read them
+        if self.data_flattening_max_level == 0:
+            try:
+                return ','.join(str(record[p]) for p in key_properties)
+            except KeyError:
+                pass
+
         flatten = flattening.flatten_record(record, max_level=self.data_flattening_max_level)
-        primary_keys = [sql_utils.safe_column_name(p, quotes=False) for p in self.stream_schema_message['key_properties']]
         try:
-            key_props = [str(flatten[p]) for p in primary_keys]
-        except Exception as exc:
-            logger.info("Cannot find {} primary key(s) in record: {}".format(primary_keys, flatten))
-            raise exc
-        return ','.join(key_props)
+            return ','.join(str(flatten[p]) for p in self._primary_keys)
+        except KeyError:
+            logger.info("Cannot find {} primary key(s) in record: {}".format(self._primary_keys, flatten))
+            raise
 
     def avro_schema(self):
         project_id = self.connection_config['project_id']
-        pattern = r"[^A-Za-z0-9_]"
-        clean_project_id = re.sub(pattern, '', project_id)
+        clean_project_id = UNSAFE_AVRO_NAME_CHARS.sub('', project_id)
         schema = {
              "type": "record",
              "namespace": "{}.{}.pipelinewise.avro".format(
@@ -323,55 +460,78 @@ class DbSync:
                  self.schema_name,
                  ),
              "name": self.stream_schema_message['stream'],
-             "fields": [column_schema_avro(name, c) for name, c in self.flatten_schema.items()]}
+             "fields": self._build_schemas()[1]}
 
-        if re.search(pattern, schema['name']):
+        if UNSAFE_AVRO_NAME_CHARS.search(schema['name']):
             schema["alias"] = schema['name']
-            schema["name"] = re.sub(pattern, "_", schema['name'])
+            schema["name"] = UNSAFE_AVRO_NAME_CHARS.sub("_", schema['name'])
 
         return schema
 
+    def parsed_avro_schema(self):
+        """Avro schema parsed by fastavro. It only depends on the stream schema so it's parsed once"""
+        if self._parsed_avro_schema is None:
+            self._parsed_avro_schema = parse_schema(self.avro_schema())
+        return self._parsed_avro_schema
+
     # TODO: write tests for the json.dumps lines below and verify nesting
-    # TODO: improve performance
     def records_to_avro(self, records):
+        # bound to locals since they are used for every value of every record
+        max_int, min_int = MAX_INT, -MAX_INT
+        to_decimal = Decimal
+        dumps = JSON_ENCODER.encode
+        # the flattened record is a new dict so only the values that need converting are replaced in it.
+        # fastavro writes missing columns as null and ignores the ones that aren't in the schema
+        conversions = [(name, conversion) for name, conversion in self._avro_conversions
+                       if conversion != AVRO_VALUE]
         for record in records:
             flatten = flattening.flatten_record(record, max_level=self.data_flattening_max_level)
-            result = {}
-            for name, props in self.flatten_schema.items():
-                if name in flatten:
-                    if is_unstructured_object(props):
-                        result[name] = json.dumps(flatten[name])
-                    # dump to string if array without items or recursive
-                    elif ('array' in props['type'] and
-                          (not 'items' in props
-                           or '$ref' in props['items'])):
-                        result[name] = json.dumps(flatten[name])
-                    # dump array elements to strings
-                    elif (
-                        'array' in props['type'] and
-                        is_unstructured_object(props.get('items', {}))
-                    ):
-                        result[name] = [json.dumps(value) for value in flatten[name]]
-                    elif 'number' in props['type']:
-                        if flatten[name] is None:
-                            result[name] = None
-                        else:
-                            n = Decimal(flatten[name])
-                            # limit n to the range -MAX_NUM to MAX_NUM
-                            result[name] = MAX_NUM if n > MAX_NUM else -MAX_NUM if n < -MAX_NUM else n.quantize(ALLOWED_DECIMALS)
-                    else:
-                        result[name] = flatten[name] if name in flatten else ''
+            for name, conversion in conversions:
+                if name not in flatten:
+                    continue
+                value = flatten[name]
+                if conversion == AVRO_JSON:
+                    # a null in an unstructured column is stored as the JSON string 'null'
+                    flatten[name] = dumps(value)
+                elif value is None:
+                    continue
+                elif conversion == AVRO_JSON_ITEMS:
+                    flatten[name] = [dumps(item) for item in value]
+                elif type(value) is int and min_int <= value <= max_int:
+                    # integers in range don't need clamping nor rounding
+                    flatten[name] = to_decimal(value)
                 else:
-                    result[name] = None
-            yield result
+                    flatten[name] = avro_number(value)
+            yield flatten
 
-    def load_avro(self, f, count):
+    def load_avro(self, f, count, delete_rows=False):
         stream_schema_message = self.stream_schema_message
         stream = stream_schema_message['stream']
+        # The SQL statements only need the table references, fetching the tables would
+        # cost an API round-trip each on every flush
         target_table_ref = self.ref_helper.table_ref_from_stream(stream, is_temporary=False)
-        target_table = self.client.get_table(target_table_ref)
         logger.info("Loading {} rows into '{}'".format(count, target_table_ref.table_id))
 
+        job_config = bigquery.LoadJobConfig()
+        job_config.source_format = bigquery.SourceFormat.AVRO
+        job_config.use_avro_logical_types = True
+
+        # With a known size small files are sent in a single multipart request,
+        # otherwise the client always starts a resumable upload session first
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+
+        if self.loads_directly():
+            job_config.write_disposition = 'WRITE_APPEND'
+            # Not retried, a load job that failed to report its result could have appended the rows already
+            job = self.client.load_table_from_file(f, target_table_ref, rewind=True, size=size,
+                                                   job_config=job_config)
+            job.result()
+            if delete_rows:
+                self.query(sql_utils.delete_deleted_rows_sql(target_table_ref))
+            logger.info('LOADED {} rows'.format(job.output_rows))
+            return
+
         temp_table_ref = self.ref_helper.table_ref_from_stream(stream, is_temporary=True)
 
         logger.info("INSERTING INTO {} ({})".format(
@@ -379,32 +539,85 @@ class DbSync:
             ', '.join(self.column_names())
         ))
 
-        job_config = bigquery.LoadJobConfig()
-        job_config.source_format = bigquery.SourceFormat.AVRO
-        job_config.use_avro_logical_types = True
         job_config.write_disposition = 'WRITE_TRUNCATE'
-        job = self.client.load_table_from_file(f, temp_table_ref, job_config=job_config)
-        job.result()
-        temp_table = self.client.get_table(temp_table_ref)
-
-        pk_columns_names = primary_column_names(self.stream_schema_message)
-        if pk_columns_names and not self.connection_config.get('append_only', False):
-            # TODO: make temp table creation and DML atomic with merge
-            query = sql_utils.merge_from_table_sql(temp_table,
-                                                   target_table,
-                                                   self.column_names(),
-                                                   self.renamed_columns,
-                                                   pk_columns_names)
-        else:
-            query = sql_utils.insert_from_table_sql(temp_table,
-                                                    target_table,
-                                                    self.column_names())
-        drop_temp_query = sql_utils.drop_table_sql(temp_table)
-        results = self.query([query, drop_temp_query])
-        logger.info('LOADED {} rows'.format(results.num_dml_affected_rows))
+
+        # The temp table is truncated by every load job so a failed load can safely run again
+        @RETRY_TRANSIENT_ERRORS
+        def load_temp_table():
+            job = self.client.load_table_from_file(f, temp_table_ref, rewind=True, size=size,
+                                                       job_config=job_config)
+            job.result()
+
+        load_temp_table()
+
+        # The affected rows of a script job are not the ones of its MERGE or INSERT
+        # so they are kept in a variable returned by the last statement
+        queries = ['DECLARE loaded_rows INT64', self.load_from_temp_table_sql(), 'SET loaded_rows = @@row_count']
+        if delete_rows:
+            # Delete soft-deleted rows in the same script instead of running another query job,
+            # the transaction avoids exposing them between both statements
+            queries.insert(1, 'BEGIN TRANSACTION')
+            queries.append(sql_utils.delete_deleted_rows_sql(target_table_ref))
+            queries.append('COMMIT TRANSACTION')
+        queries.append(sql_utils.drop_table_sql(temp_table_ref))
+        queries.append('SELECT loaded_rows')
+        results = self.query(queries)
+        logger.info('LOADED {} rows'.format(next(iter(results.result())).loaded_rows))
+
+    def is_merged(self):
+        """Rows of streams with primary keys are merged into the target table unless they are append only"""
+        return bool(primary_column_names(self.stream_schema_message)) and \
+            not self.connection_config.get('append_only', False)
+
+    def loads_directly(self):
+        """Rows that are only inserted can skip the temp table when direct_load is enabled
+
+        The Avro file has to match the target table so it can't be used once columns got versioned
+        """
+        return self.connection_config.get('direct_load', False) and not self.is_merged() and not self.renamed_columns
+
+    def load_from_temp_table_sql(self):
+        """MERGE or INSERT statement copying the temp table into the target table
+
+        It only changes when columns get renamed so it's built once and reused by every load
+        """
+        if self._load_from_temp_table_sql is None:
+            stream = self.stream_schema_message['stream']
+            target_table_ref = self.ref_helper.table_ref_from_stream(stream, is_temporary=False)
+            temp_table_ref = self.ref_helper.table_ref_from_stream(stream, is_temporary=True)
+
+            if self.is_merged():
+                pk_columns_names = primary_column_names(self.stream_schema_message)
+                # TODO: make temp table creation and DML atomic with merge
+                self._load_from_temp_table_sql = sql_utils.merge_from_table_sql(temp_table_ref,
+                                                                                 target_table_ref,
+                                                                                 self.column_names(),
+                                                                                 self.renamed_columns,
+                                                                                 pk_columns_names)
+            else:
+                self._load_from_temp_table_sql = sql_utils.insert_from_table_sql(temp_table_ref,
+                                                                                  target_table_ref,
+                                                                                  self.column_names())
+        return self._load_from_temp_table_sql
+
+    def _build_schemas(self):
+        """BigQuery and Avro fields of every column, built together in one pass over the flattened schema"""
+        if self._schema_fields is None:
+            schema_fields = {}
+            avro_schema_fields = []
+            for (name, properties_schema) in self.flatten_schema.items():
+                schema_fields[name] = column_schema(name, properties_schema)
+                avro_schema_fields.append(column_schema_avro(name, properties_schema))
+            self._schema_fields = schema_fields
+            self._avro_schema_fields = avro_schema_fields
+        return self._schema_fields, self._avro_schema_fields
+
+    def schema_fields(self):
+        """BigQuery SchemaField of every column by flattened name. It only depends on the stream schema so it's built once"""
+        return self._build_schemas()[0]
 
     def column_names(self):
-        return [sql_utils.safe_column_name(name) for name in self.flatten_schema]
+        return self._column_names
 
     def create_table(self, is_temporary=False):
         stream_schema_message = self.stream_schema_message
@@ -412,48 +625,38 @@ class DbSync:
 
         table_ref = self.ref_helper.table_ref_from_stream(stream, is_temporary)
 
-        schema = [
-            column_schema(
-                name,
-                schema
-            )
-            for (name, schema) in self.flatten_schema.items()
-        ]
-
-        table = bigquery.Table(table_ref, schema=schema)
+        table = bigquery.Table(table_ref, schema=list(self.schema_fields().values()))
         if is_temporary:
             table.expires = datetime.datetime.now() + datetime.timedelta(days=1)
 
-        self.client.create_table(table)
+        created_table = self.client.create_table(table)
+        if not is_temporary:
+            self._target_table = created_table
 
-    def grant_usage_on_schema(self, schema_name, grantee):
-        query = "GRANT USAGE ON SCHEMA {} TO GROUP {}".format(schema_name, grantee)
-        logger.info("Granting USAGE privilegue on '{}' schema to '{}'... {}".format(schema_name, grantee, query))
-        self.query(query)
+    def grant_read_access(self, schema_name, grantees, dataset=None):
+        """Give the grantee groups read access to every table of the dataset
 
-    def grant_select_on_all_tables_in_schema(self, schema_name, grantee):
-        query = "GRANT SELECT ON ALL TABLES IN SCHEMA {} TO GROUP {}".format(schema_name, grantee)
-        logger.info("Granting SELECT ON ALL TABLES privilegue on '{}' schema to '{}'... {}".format(schema_name, grantee, query))
-        self.query(query)
+        Every missing grantee is added to the dataset access entries with a single update instead of a query per grantee
+        """
+        if dataset is None:
+            dataset = self.client.get_dataset(
+                bigquery.DatasetReference(self.connection_config['project_id'], schema_name))  # API request
+
+        access_entries = list(dataset.access_entries)
+        new_entries = [bigquery.AccessEntry('READER', 'groupByEmail', grantee) for grantee in grantees]
+        new_entries = [entry for entry in new_entries if entry not in access_entries]
+        if new_entries:
+            logger.info("Granting READER access on '{}' schema to '{}'".format(
+                schema_name, [entry.entity_id for entry in new_entries]))
+            dataset.access_entries = access_entries + new_entries
+            self.client.update_dataset(dataset, ['access_entries'])  # API request
 
     @classmethod
-    def grant_privilege(cls, schema, grantees, grant_method):
-        if isinstance(grantees, list):
-            for grantee in grantees:
-                grant_method(schema, grantee)
-        elif isinstance(grantees, str):
-            grant_method(schema, grantees)
-
-    def delete_rows(self, stream):
-        stream_schema_message = self.stream_schema_message
-        stream = stream_schema_message['stream']
-
-        table_ref = self.ref_helper.table_ref_from_stream(stream, is_temporary=False)
-        table_id = table_ref.table_id
-        query = "DELETE FROM {} WHERE _sdc_deleted_at IS NOT NULL".format(
-                    sql_utils.safe_table_ref(table_ref))
-        logger.info("Deleting rows from '{}' table... {}".format(table_id, query))
-        logger.info("DELETE {}".format(self.query(query).result().total_rows))
+    def grant_privilege(cls, schema, grantees, grant_method, **kwargs):
+        if isinstance(grantees, str):
+            grantees = [grantees]
+        if grantees:
+            grant_method(schema, grantees, **kwargs)
 
     def activate_table_version(self, stream, version):
         stream_schema_message = self.stream_schema_message
@@ -474,54 +677,61 @@ class DbSync:
         project_id = self.connection_config['project_id']
 
         for schema in set([schema_name, temp_schema]):
+            if (project_id, schema) in EXISTING_DATASETS:
+                continue
             try:
-                self.client.create_dataset(bigquery.DatasetReference(project_id, schema))
+                dataset = self.client.create_dataset(bigquery.DatasetReference(project_id, schema))
                 logger.info("Schema '{}' does not exist. Creating...".format(schema))
-                self.grant_privilege(schema, self.grantees, self.grant_usage_on_schema)
+                self.grant_privilege(schema, self.grantees, self.grant_read_access, dataset=dataset)
             except Conflict:
                 # Already exists.
                 pass
+            EXISTING_DATASETS.add((project_id, schema))
 
     # pylint: disable=no-self-use
     def alias_field(self, field, alias):
-        api_repr = field.to_api_repr()
+        # newer google-cloud-bigquery versions return the field's own properties, copy them to keep field untouched
+        api_repr = dict(field.to_api_repr())
         api_repr['name'] = alias
         return SchemaField.from_api_repr(api_repr)
 
-    def get_table_columns(self, table_ref: bigquery.TableReference):
-        table = self.client.get_table(table_ref)
-        return {field.name: field for field in table.schema}
+    def target_table(self):
+        """Target table of the stream, fetched once per sync_table and replaced by the target's own updates"""
+        if self._target_table is None:
+            stream = self.stream_schema_message['stream']
+            table_ref = self.ref_helper.table_ref_from_stream(stream, is_temporary=False)
+            self._target_table = self.client.get_table(table_ref)  # API request
+        return self._target_table
+
+    def get_table_columns(self):
+        return {field.name: field for field in self.target_table().schema}
 
     def update_columns(self):
         stream_schema_message = self.stream_schema_message
         stream = stream_schema_message['stream']
-        table_ref = self.ref_helper.table_ref_from_stream(stream, is_temporary=False)
-        columns = self.get_table_columns(table_ref)
+        columns = self.get_table_columns()
+
+        columns_to_add = []
+        columns_to_replace = []
+        # the field names are the safe, lowercase column names
+        for field in self.schema_fields().values():
+            existing_field = columns.get(field.name)
+            if existing_field is None:
+                columns_to_add.append(field)
+            elif existing_field != field:
+                columns_to_replace.append(field)
 
-        columns_to_add = [
-            column_schema(name, properties_schema)
-            for (name, properties_schema) in self.flatten_schema.items()
-            if sql_utils.safe_column_name(name, quotes=False) not in columns
-        ]
+        for field in columns_to_replace:
+            versioned_field = self.version_column(field, stream, columns_to_add)
+            if versioned_field:
+                columns_to_add.append(versioned_field)
 
+        # every new and versioned column is added with a single table update
         if columns_to_add:
             self.add_columns(columns_to_add, stream)
 
-        columns_to_replace = [
-            column_schema(name, properties_schema)
-            for (name, properties_schema) in self.flatten_schema.items()
-            if name.lower() in columns and
-               columns[name.lower()] != column_schema(name, properties_schema)
-        ]
-
-        for field in columns_to_replace:
-            self.version_column(field, stream)
-
     def update_clustering_fields(self):
-        stream_schema_message = self.stream_schema_message
-        stream = stream_schema_message['stream']
-        table_ref = self.ref_helper.table_ref_from_stream(stream, is_temporary=False)
-        table = self.client.get_table(table_ref)  # API request
+        table = self.target_table()
 
         new_clustering_fields = [
             self.renamed_columns.get(c, c) for c in primary_column_names(self.stream_schema_message)
@@ -535,69 +745,65 @@ class DbSync:
         if new_clustering_fields_limited and not table.clustering_fields:
             logger.info('Clustering table on fields: {}'.format(new_clustering_fields_limited))
             table.clustering_fields = new_clustering_fields_limited
-            self.client.update_table(table, ['clustering_fields'])
+            self._target_table = self.client.update_table(table, ['clustering_fields'])
 
         # avoid changing existing clusters so its possible to manually change clustering of a table outside of this target
         elif table.clustering_fields != new_clustering_fields_limited:
             logger.info('Primary key fields have changed. Uncluster the table to allow the change: {}'.format(new_clustering_fields_limited))
 
-    def version_column(self, field, stream):
+    def version_column(self, field, stream, new_fields=()):
+        """Find the column that stores field with its new type. Returns the field to add if there isn't one yet
+
+        new_fields are columns about to be added to the table, they can be reused as well
+        """
         column = sql_utils.safe_column_name(field.name, quotes=False)
-        col_type_suffixes = {
-            'timestamp': 'ti',
-            'date': 'dy',
-            'time': 'tm',
-            'numeric': 'de',
-            'string': 'st',
-            'int64': 'it',
-            'integer': 'it',
-            'bool': 'bo',
-            'boolean': 'bo',
-            'array': 'arr',
-            'struct': 'sct'}
 
         if field.field_type == 'REPEATED':
-            field_with_type_suffix = '{}__{}{}'.format(column, col_type_suffixes['array'], time.strftime("%Y%m%d_%H%M"))
+            field_with_type_suffix = '{}__{}{}'.format(column, COLUMN_TYPE_SUFFIXES['array'], time.strftime("%Y%m%d_%H%M"))
         elif field.field_type == 'RECORD':
-            field_with_type_suffix = '{}__{}{}'.format(column, col_type_suffixes['struct'], time.strftime("%Y%m%d_%H%M"))
+            field_with_type_suffix = '{}__{}{}'.format(column, COLUMN_TYPE_SUFFIXES['struct'], time.strftime("%Y%m%d_%H%M"))
         else:
-            field_with_type_suffix = '{}__{}'.format(column, col_type_suffixes[field.field_type])
+            field_with_type_suffix = '{}__{}'.format(column, COLUMN_TYPE_SUFFIXES[field.field_type])
 
-        field_without_dt_suffix = re.sub(r"[0-9]{8}_[0-9]{4}", "", field_with_type_suffix)
+        field_without_dt_suffix = strip_datetime_suffix(field_with_type_suffix)
 
-        stream_schema_message = self.stream_schema_message
-        stream = stream_schema_message['stream']
-        table_ref = self.ref_helper.table_ref_from_stream(stream, is_temporary=False)
-        table_columns = self.get_table_columns(table_ref)
+        table_columns = self.get_table_columns()
+        table_columns.update((new_field.name, new_field) for new_field in new_fields)
+
+        # the field without its name is compared with every candidate column
+        unnamed_field = self.alias_field(field, '')
 
         # check if we already have this column in the table with a name like column_name__type_suffix
         for col, schemafield in table_columns.items():
             # this is a existing table column without the date suffix that gets added to arrays and structs
-            col_without_dt_suffix = re.sub(r"[0-9]{8}_[0-9]{4}", "", col)
+            col_without_dt_suffix = strip_datetime_suffix(col)
 
-            if (col_without_dt_suffix in [column, field_without_dt_suffix] and
-                self.alias_field(field, '') == self.alias_field(schemafield, '')):
+            if (col_without_dt_suffix in (column, field_without_dt_suffix) and
+                unnamed_field == self.alias_field(schemafield, '')):
                 # example: the column named ID in the stage table exists as ID__int in the final table
                 self.renamed_columns[column] = col
+                self._load_from_temp_table_sql = None
 
         # if we didnt find a existing suitable column, create it
         if not column in self.renamed_columns:
             logger.info('Versioning column: {}'.format(field_with_type_suffix))
-            self.add_columns([self.alias_field(field, field_with_type_suffix)], stream)
             self.renamed_columns[column] = field_with_type_suffix
+            self._load_from_temp_table_sql = None
+            return self.alias_field(field, field_with_type_suffix)
+
+        return None
 
     def add_columns(self, fields, stream):
         stream_schema_message = self.stream_schema_message
         stream = stream_schema_message['stream']
-        table_ref = self.ref_helper.table_ref_from_stream(stream, is_temporary=False)
-        table = self.client.get_table(table_ref)  # API request
+        table = self.target_table()
 
         schema = table.schema[:]
         schema.extend(fields)
         table.schema = schema
 
         logger.info('Adding columns: {}'.format([field.name for field in fields]))
-        self.client.update_table(table, ['schema'])  # API request
+        self._target_table = self.client.update_table(table, ['schema'])  # API request
 
     def sync_table(self):
         stream_schema_message = self.stream_schema_message
@@ -605,10 +811,12 @@ class DbSync:
         table_ref = self.ref_helper.table_ref_from_stream(stream, is_temporary=False)
 
         table_name_with_schema = f'{table_ref.dataset_id}.{table_ref.table_id}'
+        # the table could have been changed outside of the target since the last sync
+        self._target_table = None
         try:
             self.create_table()
             logger.info("Table '{}' does not exist. Creating...".format(table_name_with_schema))
-            self.grant_privilege(self.schema_name, self.grantees, self.grant_select_on_all_tables_in_schema)
+            self.grant_privilege(self.schema_name, self.grantees, self.grant_read_access)
         except Conflict:
             logger.info("Table '{}' exists".format(table_name_with_schema))
             self.update_columns()
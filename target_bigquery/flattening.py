@@ -1,21 +1,31 @@
-import itertools
+import functools
 import re
-from typing import MutableMapping
+from collections.abc import MutableMapping
 from target_bigquery.sql_utils import safe_column_name
 
+CAMELIZE_PATTERN = re.compile(r"(?:^|_)(.)")
+LOWERCASE_CHARS = re.compile(r'[a-z]')
+
 
 def camelize(string):
-    return re.sub(r"(?:^|_)(.)", lambda m: m.group(1).upper(), string)
+    return CAMELIZE_PATTERN.sub(lambda m: m.group(1).upper(), string)
+
+
+@functools.lru_cache(maxsize=1024)
+def reduce_key(key):
+    reduced_key = LOWERCASE_CHARS.sub('', camelize(key))
+    return (reduced_key if len(reduced_key) > 1 else key[0:3]).lower()
 
 
 def flatten_key(k, parent_key, sep):
-    full_key = parent_key + [k]
-    inflected_key = full_key.copy()
+    inflected_key = [*parent_key, k]
+    # keep track of the joined length instead of joining again after every reduction
+    key_length = sum(map(len, inflected_key)) + len(sep) * (len(inflected_key) - 1)
     reducer_index = 0
-    while len(sep.join(inflected_key)) >= 255 and reducer_index < len(inflected_key):
-        reduced_key = re.sub(r'[a-z]', '', camelize(inflected_key[reducer_index]))
-        inflected_key[reducer_index] = \
-            (reduced_key if len(reduced_key) > 1 else inflected_key[reducer_index][0:3]).lower()
+    while key_length >= 255 and reducer_index < len(inflected_key):
+        reduced_key = reduce_key(inflected_key[reducer_index])
+        key_length += len(reduced_key) - len(inflected_key[reducer_index])
+        inflected_key[reducer_index] = reduced_key
         reducer_index += 1
 
     return sep.join(inflected_key)
@@ -36,37 +46,52 @@ def flatten_schema(d, parent_key=[], sep='__', level=0, max_level=0):
             else:
                 items.append((new_key, v))
         else:
-            if len(v.values()) > 0:
-                if list(v.values())[0][0]['type'] == 'string':
-                    list(v.values())[0][0]['type'] = ['null', 'string']
-                    items.append((new_key, list(v.values())[0][0]))
-                elif list(v.values())[0][0]['type'] == 'array':
-                    list(v.values())[0][0]['type'] = ['null', 'array']
-                    items.append((new_key, list(v.values())[0][0]))
-                elif list(v.values())[0][0]['type'] == 'object':
-                    list(v.values())[0][0]['type'] = ['null', 'object']
-                    items.append((new_key, list(v.values())[0][0]))
-
-    key_func = lambda item: item[0]
-    sorted_items = sorted(items, key=key_func)
-    for k, g in itertools.groupby(sorted_items, key=key_func):
-        if len(list(g)) > 1:
+            if len(v) > 0:
+                first_schema = next(iter(v.values()))[0]
+                first_type = first_schema['type']
+                if first_type in ('string', 'array', 'object'):
+                    first_schema['type'] = ['null', first_type]
+                    items.append((new_key, first_schema))
+
+    flattened = {}
+    for k, v in items:
+        if k in flattened:
             raise ValueError('Duplicate column name produced in schema: {}'.format(k))
+        flattened[k] = v
 
-    return dict(sorted_items)
+    return dict(sorted(flattened.items()))
 
 
-def flatten_record(d, parent_key=[], sep='__', level=0, max_level=0):
-    items = []
+@functools.lru_cache(maxsize=8192)
+def top_level_key(k):
+    return flatten_key(safe_column_name(k, quotes=False), (), '')
+
+
+def rename_keys(d):
+    """flatten_record without flattening, it only makes the keys of the record and its nested dicts safe"""
+    return {top_level_key(k): rename_keys(v) if type(v) is dict else v for k, v in d.items()}
+
+
+@functools.lru_cache(maxsize=8192)
+def record_key(k, parent_key, sep):
+    """Safe name of the key and its flattened name. Records of a stream repeat the same keys so both are cached"""
+    safe_key = safe_column_name(k, quotes=False)
+    return safe_key, flatten_key(safe_key, parent_key, sep)
+
+
+def flatten_record(d, parent_key=(), sep='__', level=0, max_level=0):
+    if max_level == 0 and not parent_key:
+        return rename_keys(d)
+
+    items = {}
     for k, v in d.items():
-        k = safe_column_name(k, quotes=False)
-        new_key = flatten_key(k, parent_key, sep)
-        if isinstance(v, MutableMapping) and level < max_level:
-            items.extend(flatten_record(v, parent_key + [k], sep=sep, level=level+1, max_level=max_level).items())
+        k, new_key = record_key(k, parent_key, sep)
+        is_dict = type(v) is dict
+        if level < max_level and (is_dict or isinstance(v, MutableMapping)):
+            items.update(flatten_record(v, parent_key + (k,), sep=sep, level=level+1, max_level=max_level))
+        elif is_dict:
+            # Need to fix the keys of nested dicts, lowercase etc
+            items[new_key] = flatten_record(v, level=0, max_level=0)
         else:
-            if type(v) is dict:
-                # Need to fix the keys of nested dicts, lowercase etc
-                items.append((new_key, flatten_record(v, level = 0, max_level=0)))
-            else:
-                items.append((new_key, v))
-    return dict(items)
+            items[new_key] = v
+    return items
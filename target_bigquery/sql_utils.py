@@ -1,14 +1,29 @@
+import functools
 from google.cloud import bigquery
 from typing import List, Tuple, Union, Dict
 import re
+import string
 
+TableOrRef = Union[bigquery.Table, bigquery.TableReference]
+UNSAFE_COLUMN_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+# str.translate table removing backticks and replacing every other unsafe ASCII character with _
+SAFE_COLUMN_TRANSLATION = str.maketrans({
+    c: None if c == '`' else '_'
+    for c in map(chr, range(128))
+    if c not in string.ascii_letters + string.digits + '_'
+})
+
+# The same few column names get sanitised for every record
+@functools.lru_cache(maxsize=8192)
 def safe_column_name(name: str, quotes: bool = False) -> str:
-    name = name.replace('`', '')
-    pattern = '[^a-zA-Z0-9_]'
-    name = re.sub(pattern, '_', name)
+    if name.isascii():
+        name = name.translate(SAFE_COLUMN_TRANSLATION)
+    else:
+        name = UNSAFE_COLUMN_CHARS.sub('_', name.replace('`', ''))
+    name = name.lower()
     if quotes:
-        return '`{}`'.format(name).lower()
-    return '{}'.format(name).lower()
+        return f'`{name}`'
+    return name
 
 def safe_table_ref(table_ref: bigquery.TableReference) -> str:
     project_name = table_ref.project
@@ -16,12 +31,15 @@ def safe_table_ref(table_ref: bigquery.TableReference) -> str:
     table_name = table_ref.table_id
     return '`{}`.`{}`.`{}`'.format(project_name, dataset_name, table_name)
 
-def drop_table_sql(table: bigquery.Table) -> str:
+def delete_deleted_rows_sql(table: TableOrRef) -> str:
+    return "DELETE FROM {} WHERE _sdc_deleted_at IS NOT NULL".format(safe_table_ref(table))
+
+def drop_table_sql(table: TableOrRef) -> str:
     return f"DROP TABLE IF EXISTS `{table.dataset_id}.{table.table_id}`"
 
 
-def insert_from_table_sql(src: bigquery.Table,
-                          dest: bigquery.Table,
+def insert_from_table_sql(src: TableOrRef,
+                          dest: TableOrRef,
                           columns: List[str]) -> str:
     return """INSERT INTO `{}` ({})
             (SELECT s.* FROM `{}` s)
@@ -33,11 +51,13 @@ def insert_from_table_sql(src: bigquery.Table,
 
 
 #pylint: disable=too-many-arguments
-def merge_from_table_sql(src: bigquery.Table,
-                         dest: bigquery.Table,
+def merge_from_table_sql(src: TableOrRef,
+                         dest: TableOrRef,
                          columns: List[str],
                          renamed_columns: Dict[str, str],
                          primary_key_column_names: List[str]) -> str:
+    quoted_columns = [safe_column_name(c, quotes=True) for c in columns]
+    quoted_renamed_columns = [safe_column_name(renamed_columns.get(c, c), quotes=True) for c in columns]
 
     query = """
     -- run the merge statement
@@ -53,14 +73,10 @@ def merge_from_table_sql(src: bigquery.Table,
         source=f'{src.dataset_id}.{src.table_id}',
         primary_key_condition=primary_key_condition(primary_key_column_names, renamed_columns),
         set_values=', '.join(
-            '{}=s.{}'.format(
-                safe_column_name(renamed_columns.get(c, c), quotes=True),
-                safe_column_name(c, quotes=True))
-            for c in columns),
-        renamed_cols=', '.join(
-            safe_column_name(renamed_columns.get(c, c), quotes=True)
-            for c in columns),
-        cols=', '.join(safe_column_name(c,quotes=True) for c in columns))
+            '{}=s.{}'.format(renamed_column, column)
+            for renamed_column, column in zip(quoted_renamed_columns, quoted_columns)),
+        renamed_cols=', '.join(quoted_renamed_columns),
+        cols=', '.join(quoted_columns))
     return query
 
 
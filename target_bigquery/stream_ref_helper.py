@@ -1,8 +1,11 @@
+import functools
 import re
 from google.cloud import bigquery
 
 from target_bigquery import stream_utils
 
+UNSAFE_TABLE_CHARS = re.compile(r'[^a-zA-Z0-9]')
+
 class StreamRefHelper:
     def __init__(self,
                  project_id: str,
@@ -11,21 +14,23 @@ class StreamRefHelper:
         self.project_id = project_id
         self.schema_name = schema_name
         self.temp_schema_name = temp_schema_name if temp_schema_name else schema_name
+        # the references are needed by every load, they only depend on the stream name
+        self._table_refs = {}
 
     @classmethod
+    @functools.lru_cache(maxsize=None)
     def table_id_from_stream(cls, stream_name: str) -> str:
         stream_dict = stream_utils.stream_name_to_dict(stream_name)
-        bad_table_name_chars = '[^a-zA-Z0-9]'
-        table_id = re.sub(
-                       bad_table_name_chars,
-                       '_',
-                       stream_dict['table_name']
-                   ).lower()
+        table_id = UNSAFE_TABLE_CHARS.sub('_', stream_dict['table_name']).lower()
         return table_id
 
     def table_ref_from_stream(self,
                               stream_name: str,
                               is_temporary: bool = False) -> bigquery.TableReference:
+        key = (stream_name, is_temporary)
+        if key in self._table_refs:
+            return self._table_refs[key]
+
         # get table id
         table_id = self.table_id_from_stream(stream_name)
 
@@ -38,4 +43,5 @@ class StreamRefHelper:
             dataset_id = self.schema_name
 
         table_ref = bigquery.DatasetReference(project_id, dataset_id).table(table_id)
+        self._table_refs[key] = table_ref
         return table_ref
@@ -36,6 +36,24 @@ def get_schema_names_from_config(config: Dict) -> List:
     return schema_names
 
 
+def get_timestamp_properties(schema: Dict) -> Dict[str, str]:
+    """
+    Finds the properties of the schema that are of type date/datetime/time
+    Args:
+        schema: json schema that has types of each property
+    Returns:
+        dictionary with the format of each date/datetime/time property
+    """
+    timestamp_properties = {}
+    for key, prop in schema.get('properties', {}).items():
+        for type_dict in prop.get('anyOf', [prop]):
+            if 'string' in type_dict.get('type', []) and type_dict.get('format', None) in {'date-time', 'time', 'date'}:
+                timestamp_properties[key] = type_dict['format']
+                break
+
+    return timestamp_properties
+
+
 def adjust_timestamps_in_record(record: Dict, schema: Dict) -> None:
     """
     Goes through every field that is of type date/datetime/time and if its value is out of range,
@@ -44,6 +62,17 @@ def adjust_timestamps_in_record(record: Dict, schema: Dict) -> None:
         record: record containing properties and values
         schema: json schema that has types of each property
     """
+    adjust_timestamps(record, get_timestamp_properties(schema))
+
+
+def adjust_timestamps(record: Dict, timestamp_properties: Dict[str, str]) -> None:
+    """
+    Same as adjust_timestamps_in_record but with the date/datetime/time properties of the
+    schema already found by get_timestamp_properties, so the schema isn't traversed on every record
+    Args:
+        record: record containing properties and values
+        timestamp_properties: format of every date/datetime/time property
+    """
 
     # creating this internal function to avoid duplicating code and too many nested blocks.
     def reset_new_value(record: Dict, key: str, _format: str):
@@ -63,18 +92,9 @@ def adjust_timestamps_in_record(record: Dict, schema: Dict) -> None:
                            'acceptable value of %s in BigQuery', _format, record[key], key, _format)
             record[key] = MAX_TIMESTAMP if _format != 'time' else MAX_TIME
 
-    # traverse the schema looking for properties of some date type
-    for key, value in record.items():
-        if value is not None and key in schema['properties']:
-            if 'anyOf' in schema['properties'][key]:
-                for type_dict in schema['properties'][key]['anyOf']:
-                    if 'string' in type_dict['type'] and type_dict.get('format', None) in {'date-time', 'time', 'date'}:
-                        reset_new_value(record, key, type_dict['format'])
-                        break
-            else:
-                if 'string' in schema['properties'][key]['type'] and \
-                        schema['properties'][key].get('format', None) in {'date-time', 'time', 'date'}:
-                    reset_new_value(record, key, schema['properties'][key]['format'])
+    for key, _format in timestamp_properties.items():
+        if record.get(key) is not None:
+            reset_new_value(record, key, _format)
 
 
 def float_to_decimal(value):
@@ -88,6 +108,18 @@ def float_to_decimal(value):
     return value
 
 
+def schema_has_numbers(schema) -> bool:
+    """Check if any part of the schema has number types or multipleOf validations.
+    Records only need float_to_decimal before validation when it has."""
+    if isinstance(schema, list):
+        return any(schema_has_numbers(child) for child in schema)
+    if isinstance(schema, dict):
+        if 'multipleOf' in schema or 'number' in (schema.get('type') or []):
+            return True
+        return any(schema_has_numbers(child) for child in schema.values())
+    return False
+
+
 def add_metadata_values_to_record(record_message):
     """Populate metadata _sdc columns from incoming record message
     The location of the required attributes are fixed in the stream
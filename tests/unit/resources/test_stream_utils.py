@@ -36,3 +36,14 @@ class TestStreamUtils(unittest.TestCase):
         extra_attrs = ['_sdc_extracted_at', '_sdc_batched_at', '_sdc_deleted_at']
         for attr in extra_attrs:
             self.assertTrue(attr in result)
+
+    def test_schema_has_numbers(self):
+        """Test finding number types and multipleOf validations in a schema"""
+        self.assertFalse(stream_utils.schema_has_numbers(
+            {"properties": {"id": {"type": ["integer"]}, "name": {"type": "string"}}}))
+        self.assertTrue(stream_utils.schema_has_numbers(
+            {"properties": {"price": {"type": ["null", "number"]}}}))
+        self.assertTrue(stream_utils.schema_has_numbers(
+            {"properties": {"qty": {"type": ["integer"], "multipleOf": 5}}}))
+        self.assertTrue(stream_utils.schema_has_numbers(
+            {"properties": {"obj": {"anyOf": [{"type": "null"}, {"properties": {"n": {"type": "number"}}}]}}}))
@@ -1,8 +1,14 @@
+import io
 import unittest
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
+
+import fastavro
 
 from target_bigquery import db_sync
 from target_bigquery import flattening
 from target_bigquery import stream_utils
+from target_bigquery import sql_utils
 
 
 class TestDBSync(unittest.TestCase):
@@ -12,6 +18,13 @@ class TestDBSync(unittest.TestCase):
 
     def setUp(self):
         self.config = {}
+        # BigQuery clients and created datasets are cached per process, mocks must not leak between tests
+        db_sync.get_client.cache_clear()
+        db_sync.EXISTING_DATASETS.clear()
+
+    def tearDown(self):
+        db_sync.get_client.cache_clear()
+        db_sync.EXISTING_DATASETS.clear()
 
     def test_config_validation(self):
         """Test configuration validator"""
@@ -47,6 +60,18 @@ class TestDBSync(unittest.TestCase):
         }
         self.assertEqual(len(validator(config_with_schema_mapping)), 0)
 
+        # Configuration with unknown Avro codec - (nr_of_errors >= 0)
+        config_with_invalid_codec = minimal_config.copy()
+        config_with_invalid_codec['avro_codec'] = 'zip'
+        self.assertGreater(len(validator(config_with_invalid_codec)), 0)
+
+        # Configuration with an Avro codec whose library is not installed - (nr_of_errors >= 0)
+        config_with_missing_codec = minimal_config.copy()
+        config_with_missing_codec['avro_codec'] = 'snappy'
+        with patch('target_bigquery.db_sync.writer', side_effect=ValueError('install python-snappy')):
+            self.assertGreater(len(validator(config_with_missing_codec)), 0)
+        self.assertEqual(len(validator(minimal_config)), 0)
+
     def test_column_schema_mapping(self):
         """Test JSON type to BigQuery column type mappings"""
         def mapper(schema_property):
@@ -382,3 +407,220 @@ class TestDBSync(unittest.TestCase):
                               "c_obj__nested_prop3__multi_nested_prop1": "multi_value_1",
                               "c_obj__nested_prop3__multi_nested_prop2": "multi_value_2"
                           })
+
+    @patch('target_bigquery.db_sync.bigquery.Client')
+    def test_record_primary_key_string(self, client_mock):
+        """Test building the primary key string used to deduplicate records"""
+        config = {'project_id': 'dummy-project', 'default_target_schema': 'dummy_schema'}
+        schema_message = {
+            'stream': 'dummy_stream',
+            'key_properties': ['id', 'Code'],
+            'schema': {'properties': {'id': {'type': ['integer']}, 'Code': {'type': ['string']}}}
+        }
+
+        dbsync = db_sync.DbSync(config, schema_message)
+        self.assertEqual(dbsync.record_primary_key_string({'id': 1, 'Code': 'a', 'c_int': 2}), '1,a')
+        # keys that only match once sanitised are found in the flattened record
+        self.assertEqual(dbsync.record_primary_key_string({'ID': 1, 'code': 'a'}), '1,a')
+
+        schema_message['key_properties'] = []
+        dbsync = db_sync.DbSync(config, schema_message)
+        self.assertIsNone(dbsync.record_primary_key_string({'id': 1}))
+
+    @patch('target_bigquery.db_sync.bigquery.Client')
+    def test_client_shared_between_streams(self, client_mock):
+        """Test reusing the same BigQuery client for every stream of the same project"""
+        client_mock.side_effect = lambda **kwargs: MagicMock()
+        config = {'project_id': 'dummy-project', 'default_target_schema': 'dummy_schema'}
+        schema_message = {'stream': 'dummy_stream', 'key_properties': [], 'schema': {'properties': {}}}
+        other_schema_message = {'stream': 'other_stream', 'key_properties': [], 'schema': {'properties': {}}}
+
+        client = db_sync.DbSync(config, schema_message).client
+        self.assertIs(db_sync.DbSync(config, other_schema_message).client, client)
+        client_mock.assert_called_once_with(project='dummy-project', location=None)
+
+        # the mounted adapter is resized rather than replaced so mTLS adapters keep their certificate
+        client._http.get_adapter.return_value.init_poolmanager.assert_called_once_with(
+            db_sync.DEFAULT_HTTP_POOL_SIZE, db_sync.DEFAULT_HTTP_POOL_SIZE)
+        client._http.mount.assert_not_called()
+
+        config['location'] = 'EU'
+        self.assertIsNot(db_sync.DbSync(config, schema_message).client, client)
+
+    @patch('target_bigquery.db_sync.bigquery.Client')
+    def test_create_schema_once_per_dataset(self, client_mock):
+        """Test creating every dataset only once when many streams share it"""
+        config = {'project_id': 'dummy-project', 'default_target_schema': 'dummy_schema', 'temp_schema': 'temp_schema'}
+        schema_message = {'stream': 'dummy_stream', 'key_properties': [], 'schema': {'properties': {}}}
+        other_schema_message = {'stream': 'other_stream', 'key_properties': [], 'schema': {'properties': {}}}
+
+        db_sync.DbSync(config, schema_message).create_schema_if_not_exists()
+        db_sync.DbSync(config, other_schema_message).create_schema_if_not_exists()
+        self.assertEqual(client_mock.return_value.create_dataset.call_count, 2)
+
+    @patch('target_bigquery.db_sync.bigquery.Client')
+    def test_grant_read_access(self, client_mock):
+        """Test granting access on new datasets with a single dataset update"""
+        client = client_mock.return_value
+        client.create_dataset.side_effect = lambda dataset_ref: db_sync.bigquery.Dataset(dataset_ref)
+        config = {'project_id': 'dummy-project', 'default_target_schema': 'dummy_schema',
+                  'default_target_schema_select_permissions': ['group_1@example.com', 'group_2@example.com']}
+        schema_message = {'stream': 'dummy_stream', 'key_properties': [], 'schema': {'properties': {}}}
+
+        db_sync.DbSync(config, schema_message).create_schema_if_not_exists()
+        client.update_dataset.assert_called_once()
+        dataset, fields = client.update_dataset.call_args.args
+        self.assertEqual(fields, ['access_entries'])
+        self.assertEqual([entry.entity_id for entry in dataset.access_entries],
+                         ['group_1@example.com', 'group_2@example.com'])
+        client.query.assert_not_called()
+
+    @patch('target_bigquery.db_sync.bigquery.Client')
+    def test_load_avro_directly(self, client_mock):
+        """Test appending rows straight into the target table without a temp table"""
+        config = {'project_id': 'dummy-project', 'default_target_schema': 'dummy_schema', 'direct_load': True}
+        schema_message = {'stream': 'dummy_stream', 'key_properties': [], 'schema': {'properties': {}}}
+
+        dbsync = db_sync.DbSync(config, schema_message)
+        dbsync.load_avro(io.BytesIO(b'avro'), 1)
+        load_kwargs = client_mock.return_value.load_table_from_file.call_args.kwargs
+        self.assertEqual(load_kwargs['job_config'].write_disposition, 'WRITE_APPEND')
+        self.assertEqual(load_kwargs['size'], 4)
+        client_mock.return_value.query.assert_not_called()
+
+        # Merged streams and streams with versioned columns still go through the temp table
+        schema_message['key_properties'] = ['id']
+        self.assertFalse(db_sync.DbSync(config, schema_message).loads_directly())
+        dbsync.renamed_columns['c_int'] = 'c_int__st'
+        self.assertFalse(dbsync.loads_directly())
+
+    @patch('target_bigquery.db_sync.bigquery.Client')
+    def test_load_avro_through_temp_table(self, client_mock):
+        """Test merging the temp table and deleting rows in a single script"""
+        config = {'project_id': 'dummy-project', 'default_target_schema': 'dummy_schema'}
+        schema_message = {'stream': 'dummy_stream', 'key_properties': ['id'],
+                          'schema': {'properties': {'id': {'type': ['integer']}}}}
+        client_mock.return_value.query.return_value.result.return_value = [MagicMock(loaded_rows=1)]
+
+        db_sync.DbSync(config, schema_message).load_avro(io.BytesIO(), 1, delete_rows=True)
+        script = client_mock.return_value.query.call_args.args[0].split(';\n')
+        self.assertEqual(script[:2], ['DECLARE loaded_rows INT64', 'BEGIN TRANSACTION'])
+        self.assertIn('MERGE', script[2])
+        self.assertEqual(script[3], 'SET loaded_rows = @@row_count')
+        self.assertTrue(script[4].startswith('DELETE FROM'))
+        self.assertEqual(script[5:], ['COMMIT TRANSACTION',
+                                      'DROP TABLE IF EXISTS `dummy_schema.dummy_stream_temp`',
+                                      'SELECT loaded_rows'])
+
+    @patch('target_bigquery.db_sync.bigquery.Client')
+    def test_sync_table_fetches_table_once(self, client_mock):
+        """Test reusing the target table while adding columns and clustering it"""
+        client = client_mock.return_value
+        client.create_table.side_effect = db_sync.Conflict('Already exists')
+        client.get_table.return_value = db_sync.bigquery.Table(
+            'dummy-project.dummy_schema.dummy_stream',
+            schema=[db_sync.SchemaField('id', 'STRING')])
+        client.update_table.side_effect = lambda table, fields: table
+        config = {'project_id': 'dummy-project', 'default_target_schema': 'dummy_schema'}
+        schema_message = {'stream': 'dummy_stream', 'key_properties': ['id'],
+                          'schema': {'properties': {'id': {'type': ['string']},
+                                                    'c_new': {'type': ['string']}}}}
+
+        dbsync = db_sync.DbSync(config, schema_message)
+        dbsync.sync_table()
+        client.get_table.assert_called_once()
+        self.assertEqual([field.name for field in dbsync.target_table().schema], ['id', 'c_new'])
+        self.assertEqual(dbsync.target_table().clustering_fields, ['id'])
+
+    @patch('target_bigquery.db_sync.bigquery.Client')
+    def test_update_columns_in_one_table_update(self, client_mock):
+        """Test adding new and versioned columns with a single table update"""
+        client = client_mock.return_value
+        client.get_table.return_value = db_sync.bigquery.Table(
+            'dummy-project.dummy_schema.dummy_stream',
+            schema=[db_sync.SchemaField('id', 'STRING'), db_sync.SchemaField('c_obj', 'STRING')])
+        client.update_table.side_effect = lambda table, fields: table
+        config = {'project_id': 'dummy-project', 'default_target_schema': 'dummy_schema'}
+        schema_message = {'stream': 'dummy_stream', 'key_properties': ['id'],
+                          'schema': {'properties': {'id': {'type': ['string']},
+                                                    'c_obj': {'type': ['object'],
+                                                              'properties': {'key': {'type': ['string']}}},
+                                                    'c_new': {'type': ['string']}}}}
+
+        dbsync = db_sync.DbSync(config, schema_message)
+        dbsync.update_columns()
+        client.update_table.assert_called_once()
+        self.assertEqual([field.name for field in dbsync.target_table().schema][:3], ['id', 'c_obj', 'c_new'])
+        self.assertTrue(dbsync.renamed_columns['c_obj'].startswith('c_obj__sct'))
+        self.assertEqual(dbsync.target_table().schema[3].name, dbsync.renamed_columns['c_obj'])
+
+    def test_strip_datetime_suffix(self):
+        """Test removing the timestamp of versioned array and struct columns"""
+        self.assertEqual(db_sync.strip_datetime_suffix('c_obj__sct20210101_1200'), 'c_obj__sct')
+        self.assertEqual(db_sync.strip_datetime_suffix('c_int__it'), 'c_int__it')
+        self.assertEqual(db_sync.strip_datetime_suffix('c_obj__sct20210101-1200'), 'c_obj__sct20210101-1200')
+        self.assertEqual(db_sync.strip_datetime_suffix('20210101_1200'), '')
+
+    def test_safe_column_name(self):
+        """Test sanitising column names for BigQuery"""
+        self.assertEqual(sql_utils.safe_column_name('C_Int'), 'c_int')
+        self.assertEqual(sql_utils.safe_column_name('c-int 2'), 'c_int_2')
+        self.assertEqual(sql_utils.safe_column_name('`c_int`'), 'c_int')
+        self.assertEqual(sql_utils.safe_column_name('c_int', quotes=True), '`c_int`')
+        # Every non ASCII character is replaced too
+        self.assertEqual(sql_utils.safe_column_name('Ünïcode`-col'), '_n_code_col')
+
+    @patch('target_bigquery.db_sync.bigquery.Client')
+    def test_records_to_avro(self, client_mock):
+        """Test converting records to the values written to Avro"""
+        config = {'project_id': 'dummy-project', 'default_target_schema': 'dummy_schema'}
+        schema_message = {
+            'stream': 'dummy_stream',
+            'key_properties': ['id'],
+            'schema': {
+                'properties': {
+                    'id': {'type': ['integer']},
+                    'c_obj': {'type': ['null', 'object']},
+                    'c_arr': {'type': ['null', 'array']},
+                    'c_arr_obj': {'type': ['null', 'array'], 'items': {'type': ['object']}},
+                    'c_arr_str': {'type': ['null', 'array'], 'items': {'type': ['string']}},
+                    'c_num': {'type': ['null', 'number']},
+                    'c_missing': {'type': ['null', 'string']}
+                }
+            }
+        }
+        record = {
+            'id': 1,
+            'c_obj': {'key': 'value'},
+            'c_arr': [1, 2],
+            'c_arr_obj': [{'key': 1}, {'key': 2}],
+            'c_arr_str': ['a', 'b'],
+            'c_num': 1.1234567891,
+        }
+
+        dbsync = db_sync.DbSync(config, schema_message)
+        self.assertEqual(list(dbsync.records_to_avro([record])), [{
+            'id': 1,
+            'c_obj': '{"key": "value"}',
+            'c_arr': '[1, 2]',
+            'c_arr_obj': ['{"key": 1}', '{"key": 2}'],
+            'c_arr_str': ['a', 'b'],
+            'c_num': Decimal('1.123456789'),
+        }])
+
+        # missing columns are written as nulls
+        avro_file = io.BytesIO()
+        fastavro.writer(avro_file, dbsync.parsed_avro_schema(), dbsync.records_to_avro([record]))
+        avro_file.seek(0)
+        self.assertIsNone(next(fastavro.reader(avro_file))['c_missing'])
+
+        # nulls in unstructured columns are dumped to JSON but other nulls are kept
+        records = [{'id': 6, 'c_obj': None, 'c_arr': None, 'c_arr_obj': None, 'c_num': None}]
+        self.assertEqual(list(dbsync.records_to_avro(records)), [
+            {'id': 6, 'c_obj': 'null', 'c_arr': 'null', 'c_arr_obj': None, 'c_num': None}])
+
+        # numbers are limited to the precision and scale BigQuery accepts
+        records = [{'id': 2, 'c_num': None}, {'id': 3, 'c_num': 10 ** 40}, {'id': 4, 'c_num': -10 ** 40},
+                   {'id': 5, 'c_num': 10 ** 28}]
+        self.assertEqual([r['c_num'] for r in dbsync.records_to_avro(records)],
+                         [None, db_sync.MAX_NUM, -db_sync.MAX_NUM, Decimal(10 ** 28)])
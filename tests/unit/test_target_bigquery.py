@@ -1,6 +1,11 @@
 import unittest
+import io
 import os
 import itertools
+import math
+
+import fastavro
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from datetime import datetime, timedelta, date
 from unittest.mock import patch
@@ -12,6 +17,11 @@ class TestTargetBigQuery(unittest.TestCase):
 
     def setUp(self):
         self.config = {}
+        # BigQuery clients are cached per process, mocks must not leak between tests
+        target_bigquery.db_sync.get_client.cache_clear()
+
+    def tearDown(self):
+        target_bigquery.db_sync.get_client.cache_clear()
 
     @patch('target_bigquery.flush_streams')
     @patch('target_bigquery.DbSync')
@@ -82,17 +92,17 @@ class TestTargetBigQuery(unittest.TestCase):
             'key6': None
         }, record)
 
-    @patch('target_bigquery.datetime')
+    @patch('target_bigquery.time')
     @patch('target_bigquery.flush_streams')
     @patch('target_bigquery.DbSync')
-    def test_persist_40_records_with_batch_wait_limit(self, dbSync_mock, flush_streams_mock, dateTime_mock):
+    def test_persist_40_records_with_batch_wait_limit(self, dbSync_mock, flush_streams_mock, time_mock):
 
-        start_time = datetime(2021, 4, 6, 0, 0, 0)
+        start_time = 1000.0
         increment = 11
         counter = itertools.count()
 
-        # Move time forward by {{increment}} seconds every time utcnow() is called
-        dateTime_mock.utcnow.side_effect = lambda: start_time + timedelta(seconds=increment * next(counter))
+        # Move time forward by {{increment}} seconds every time monotonic() is called
+        time_mock.monotonic.side_effect = lambda: start_time + increment * next(counter)
 
         self.config['batch_size_rows'] = 100
         self.config['batch_wait_limit_seconds'] = 10
@@ -109,14 +119,15 @@ class TestTargetBigQuery(unittest.TestCase):
         def flush_streams_mock_func(
             streams,
             *_,
-            filter_streams=None
+            filter_streams=None,
+            executor=None
         ):
             if filter_streams:
                 streams_to_flush = filter_streams
             else:
                 streams_to_flush = streams.keys()
 
-            flushed_timestamps = {stream: dateTime_mock.utcnow() for stream in streams_to_flush}
+            flushed_timestamps = {stream: time_mock.monotonic() for stream in streams_to_flush}
             return {"currently_syncing": None}, flushed_timestamps
 
         flush_streams_mock.side_effect = flush_streams_mock_func
@@ -125,3 +136,183 @@ class TestTargetBigQuery(unittest.TestCase):
 
         # Expecting flush after every records + 1 at the end
         assert flush_streams_mock.call_count == 41
+
+    @patch('target_bigquery.db_sync.bigquery.Client')
+    def test_write_avro_batch_in_worker_process(self, client_mock):
+        self.config['project_id'] = 'dummy-project'
+        self.config['default_target_schema'] = 'dummy_schema'
+        schema_message = {
+            'stream': 'dummy_stream',
+            'key_properties': ['id'],
+            'schema': {
+                'properties': {
+                    'id': {'type': ['null', 'integer']},
+                    'c_varchar': {'type': ['null', 'string']}
+                }
+            }
+        }
+        records = [{'id': 1, 'c_varchar': 'a'}, {'id': 2}]
+
+        db_sync = target_bigquery.DbSync(self.config, schema_message)
+
+        # DbSync gets pickled without its BigQuery client when sent to worker processes
+        with ProcessPoolExecutor(1) as executor:
+            avro_batch = executor.submit(target_bigquery.write_avro_batch, db_sync, records).result()
+
+        self.assertIsNotNone(db_sync.client)
+        self.assertEqual(list(fastavro.reader(io.BytesIO(avro_batch))),
+                         [{'id': 1, 'c_varchar': 'a'}, {'id': 2, 'c_varchar': None}])
+
+    @patch('target_bigquery.os.cpu_count', return_value=2)
+    @patch('target_bigquery.AVRO_CHUNK_SIZE_ROWS', 2)
+    @patch('target_bigquery.db_sync.DbSync.load_avro')
+    @patch('target_bigquery.db_sync.bigquery.Client')
+    def test_flush_streams_with_parallel_transform(self, client_mock, load_avro_mock, cpu_count_mock):
+        self.config['project_id'] = 'dummy-project'
+        self.config['default_target_schema'] = 'dummy_schema'
+        self.config['parallel_transform'] = True
+        schema_message = {
+            'stream': 'dummy_stream',
+            'key_properties': ['id'],
+            'schema': {
+                'properties': {
+                    'id': {'type': ['null', 'integer']},
+                    'c_varchar': {'type': ['null', 'string']}
+                }
+            }
+        }
+        records = {str(i): {'id': i, 'c_varchar': str(i)} for i in range(5)}
+        avro_batches = []
+        load_avro_mock.side_effect = lambda f, count, delete_rows: avro_batches.append(f.read())
+
+        stream_to_sync = {'dummy_stream': target_bigquery.DbSync(self.config, schema_message)}
+        target_bigquery.flush_streams({'dummy_stream': records}, {'dummy_stream': 5}, stream_to_sync,
+                                      self.config, {}, {})
+
+        # the chunks serialised by each worker process are joined into a single Avro file
+        self.assertEqual(list(fastavro.reader(io.BytesIO(avro_batches[0]))), list(records.values()))
+
+    @patch('target_bigquery.db_sync.DbSync.load_avro')
+    @patch('target_bigquery.db_sync.bigquery.Client')
+    def test_flush_streams_with_shared_executor(self, client_mock, load_avro_mock):
+        self.config['project_id'] = 'dummy-project'
+        self.config['default_target_schema'] = 'dummy_schema'
+        stream_to_sync = {}
+        for stream in ['small_stream', 'big_stream']:
+            stream_to_sync[stream] = target_bigquery.DbSync(self.config, {
+                'stream': stream,
+                'key_properties': ['id'],
+                'schema': {'properties': {'id': {'type': ['null', 'integer']}}}
+            })
+        streams = {'small_stream': {'1': {'id': 1}}, 'big_stream': {'1': {'id': 1}, '2': {'id': 2}}}
+        avro_batches = {}
+        load_avro_mock.side_effect = lambda f, count, delete_rows: avro_batches.setdefault(count, f.read())
+
+        with ThreadPoolExecutor(1) as executor, patch.object(executor, 'submit', wraps=executor.submit) as submit:
+            target_bigquery.flush_streams(streams, {'small_stream': 1, 'big_stream': 2}, stream_to_sync,
+                                          self.config, {}, {}, executor=executor)
+
+        # only the smaller stream is sent to the executor, the biggest one is serialised in the main process
+        submit.assert_called_once()
+        self.assertIs(submit.call_args[0][1], stream_to_sync['small_stream'])
+        self.assertEqual(list(fastavro.reader(io.BytesIO(avro_batches[1]))), [{'id': 1}])
+        self.assertEqual(list(fastavro.reader(io.BytesIO(avro_batches[2]))), [{'id': 1}, {'id': 2}])
+
+    @patch('target_bigquery.AVRO_SPLIT_MIN_ROWS', 4)
+    @patch('target_bigquery.AVRO_CHUNK_SIZE_ROWS', 2)
+    @patch('target_bigquery.db_sync.DbSync.load_avro')
+    @patch('target_bigquery.db_sync.bigquery.Client')
+    def flush_big_stream(self, client_mock, load_avro_mock):
+        """Flush a single stream with enough rows to be split, returns the number of chunks sent to the
+        executor and the loaded Avro files"""
+        self.config['project_id'] = 'dummy-project'
+        self.config['default_target_schema'] = 'dummy_schema'
+        stream_to_sync = {'dummy_stream': target_bigquery.DbSync(self.config, {
+            'stream': 'dummy_stream',
+            'key_properties': ['id'],
+            'schema': {'properties': {'id': {'type': ['null', 'integer']}}}
+        })}
+        records = {str(i): {'id': i} for i in range(5)}
+        avro_batches = []
+        load_avro_mock.side_effect = lambda f, count, delete_rows: avro_batches.append(f.read())
+
+        with ThreadPoolExecutor(2) as executor, patch.object(executor, 'submit', wraps=executor.submit) as submit:
+            target_bigquery.flush_streams({'dummy_stream': records}, {'dummy_stream': 5}, stream_to_sync,
+                                          self.config, {}, {}, executor=executor)
+
+        self.assertEqual(len(avro_batches), 1)
+        self.assertEqual(list(fastavro.reader(io.BytesIO(avro_batches[0]))), list(records.values()))
+        return submit.call_count
+
+    @patch('target_bigquery.os.cpu_count', return_value=4)
+    def test_flush_streams_splits_big_stream(self, cpu_count_mock):
+        # a single stream with enough rows is serialised in chunks and loaded as one Avro file
+        self.assertEqual(self.flush_big_stream(), 3)
+
+    @patch('target_bigquery.os.cpu_count', return_value=4)
+    def test_flush_streams_with_one_worker_does_not_split(self, cpu_count_mock):
+        # with a single worker process the stream is serialised in this process instead
+        self.config['parallelism'] = 1
+        self.assertEqual(self.flush_big_stream(), 0)
+
+    @patch('target_bigquery.os.cpu_count', return_value=4)
+    def test_avro_workers(self, cpu_count_mock):
+        self.assertEqual(target_bigquery.avro_workers({}), 4)
+        self.assertEqual(target_bigquery.avro_workers({'parallelism': 2}), 2)
+        self.assertEqual(target_bigquery.avro_workers({'parallelism': 16}), 4)
+        self.assertEqual(target_bigquery.avro_workers({'parallelism': -1}), 4)
+        self.assertEqual(target_bigquery.avro_workers({'parallelism': 2, 'parallel_transform': True}), 4)
+
+    @patch('target_bigquery.flush_streams')
+    @patch('target_bigquery.DbSync')
+    def test_persist_lines_keeps_precision_of_long_integers(self, dbSync_mock, flush_streams_mock):
+        lines = [
+            '{"type": "SCHEMA", "stream": "dummy", "key_properties": [], '
+            '"schema": {"properties": {"c_num": {"type": ["null", "number"]}}}}\n',
+            '{"type": "RECORD", "stream": "dummy", "record": {"c_num": 123456789012345678901234567890}}\n',
+        ]
+        self.config['primary_key_required'] = False
+        dbSync_mock.return_value.record_primary_key_string.return_value = None
+        flush_streams_mock.return_value = None, {}
+
+        target_bigquery.persist_lines(self.config, lines)
+
+        records_to_load = flush_streams_mock.call_args[0][0]
+        self.assertEqual(list(records_to_load['dummy'].values()), [{'c_num': 123456789012345678901234567890}])
+
+    def test_parse_line_falls_back_to_json(self):
+        # integers below -2^63 and literals orjson rejects are parsed like the json module does
+        self.assertEqual(target_bigquery.parse_line('{"n": -9300000000000000000}'), {'n': -9300000000000000000})
+        self.assertEqual(target_bigquery.parse_line('{"n": 9300000000000000000}'), {'n': 9300000000000000000})
+        self.assertTrue(math.isnan(target_bigquery.parse_line('{"n": NaN}')['n']))
+        self.assertEqual(target_bigquery.parse_line('{"n": Infinity, "m": 1e400}'), {'n': math.inf, 'm': math.inf})
+        self.assertEqual(target_bigquery.parse_line('{"n": 1.5}'), {'n': 1.5})
+
+    @patch('target_bigquery.flush_streams')
+    @patch('target_bigquery.DbSync')
+    def test_persist_lines_skips_repeated_schema(self, dbSync_mock, flush_streams_mock):
+        schema = ('{"type": "SCHEMA", "stream": "dummy", "key_properties": ["id"], '
+                  '"schema": {"properties": {"id": {"type": ["integer"]}}}}\n')
+        changed_schema = ('{"type": "SCHEMA", "stream": "dummy", "key_properties": ["id"], '
+                          '"schema": {"properties": {"id": {"type": ["string"]}}}}\n')
+        lines = [
+            schema,
+            '{"type": "RECORD", "stream": "dummy", "record": {"id": 1}}\n',
+            schema,
+            '{"type": "RECORD", "stream": "dummy", "record": {"id": 2}}\n',
+            changed_schema,
+        ]
+        dbSync_mock.return_value.record_primary_key_string.side_effect = lambda record: str(record['id'])
+        flushed_records = []
+
+        def flush_streams_mock_func(streams, *_, **__):
+            flushed_records.append(list(streams['dummy']))
+            return None, {}
+
+        flush_streams_mock.side_effect = flush_streams_mock_func
+
+        target_bigquery.persist_lines(self.config, lines)
+
+        # The repeated SCHEMA neither syncs the table again nor flushes the buffered record
+        self.assertEqual(dbSync_mock.call_count, 2)
+        self.assertEqual(flushed_records, [['1', '2']])